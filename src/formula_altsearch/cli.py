@@ -1,43 +1,72 @@
 import argparse
 import difflib
 import logging
+import operator
+import re
+import sys
 import time
+from collections import defaultdict
+from functools import lru_cache
 
-from wcwidth import wcwidth
+import numpy as np
 
-from . import __version__, converter, searcher
+from . import __version__, searcher
+
+try:
+    from rapidfuzz import fuzz, process
+except ModuleNotFoundError:
+    process = None
+
+
+@lru_cache(maxsize=None)
+def _char_width(ch):
+    # import on demand as it's only needed for rendering help
+    from wcwidth import wcwidth
+    w = wcwidth(ch)
+    return 1 if w < 0 else w
 
 
 class CJKRawDescriptionHelpFormatter(argparse.RawDescriptionHelpFormatter):
     def _split_lines(self, text, width):
+        if text.isascii() and '\x00' not in text:
+            # every character has width 1: wrap by slicing
+            lines = []
+            for line in text.split('\n'):
+                if line:
+                    lines.extend(line[i:i + width] for i in range(0, len(line), width))
+                else:
+                    lines.append('')
+            if lines[-1] == '':
+                lines.pop()
+            return lines
+
         lines = []
-        buf = ''
+        buf = []
         cur_width = 0
 
         for ch in text:
-            w = wcwidth(ch)
-            if w < 0:
-                w = 1
+            # all ASCII characters except NUL are counted as width 1
+            w = 1 if '\x00' < ch < '\x7f' else _char_width(ch)
             if ch == '\n':
-                lines.append(buf)
-                buf = ''
+                lines.append(''.join(buf))
+                buf = []
                 cur_width = 0
                 continue
             if cur_width + w > width:
-                lines.append(buf)
-                buf = ch
+                lines.append(''.join(buf))
+                buf = [ch]
                 cur_width = w
             else:
-                buf += ch
+                buf.append(ch)
                 cur_width += w
         if buf:
-            lines.append(buf)
+            lines.append(''.join(buf))
         return lines
 
 
 def _bound_str(lower=None, upper=None, lower_open=False, upper_open=False):
     lb = '∞' if lower is None else lower
-    ub = '∞' if upper is None else lower
+    ub = '∞' if upper is None else upper
     lm = '(' if lower_open or lower is None else '['
     um = ')' if upper_open or upper is None else ']'
     return f'{lm}{lb}, {ub}{um}'
@@ -57,100 +86,102 @@ def name_value(value_type):
 
         return name, parsed_value
 
-    validator.__name__ = f'name_value({value_type.__name__})'
+    validator.__name__ = validator.__qualname__ = f'name_value({value_type.__name__})'
     return validator
 
 
-def bounded_float(lower=None, upper=None, lower_open=False, upper_open=False):
+def _bounded(value_type, type_desc, lower=None, upper=None, lower_open=False, upper_open=False):
+    # resolve the bound tests once here rather than on every validation
+    checks = []
+    if lower is not None:
+        checks.append((operator.gt, '>', lower) if lower_open else (operator.ge, '>=', lower))
+    if upper is not None:
+        checks.append((operator.lt, '<', upper) if upper_open else (operator.le, '<=', upper))
+    checks = tuple(checks)
+
     def validator(value):
         try:
-            value = float(value)
+            value = value_type(value)
         except ValueError:
-            raise argparse.ArgumentTypeError(f"'{value}' is not a valid float number")
-
-        if lower is not None:
-            if lower_open:
-                if not value > lower:
-                    raise argparse.ArgumentTypeError(f'value must > {lower}')
-            else:
-                if not value >= lower:
-                    raise argparse.ArgumentTypeError(f'value must >= {lower}')
+            raise argparse.ArgumentTypeError(f"'{value}' is not a valid {type_desc}")
 
-        if upper is not None:
-            if upper_open:
-                if not value < upper:
-                    raise argparse.ArgumentTypeError(f'value must < {upper}')
-            else:
-                if not value <= upper:
-                    raise argparse.ArgumentTypeError(f'value must <= {upper}')
+        for op, op_str, bound in checks:
+            if not op(value, bound):
+                raise argparse.ArgumentTypeError(f'value must {op_str} {bound}')
 
         return value
 
-    validator.__name__ = f'float{_bound_str(lower, upper, lower_open, upper_open)}'
+    validator.__name__ = validator.__qualname__ = f'{value_type.__name__}{_bound_str(lower, upper, lower_open, upper_open)}'
     return validator
 
 
+def bounded_float(lower=None, upper=None, lower_open=False, upper_open=False):
+    return _bounded(float, 'float number', lower, upper, lower_open, upper_open)
+
+
 def bounded_int(lower=None, upper=None, lower_open=False, upper_open=False):
-    def validator(value):
-        try:
-            value = int(value)
-        except ValueError:
-            raise argparse.ArgumentTypeError(f"'{value}' is not a valid integer")
+    return _bounded(int, 'integer', lower, upper, lower_open, upper_open)
 
-        if lower is not None:
-            if lower_open:
-                if not value > lower:
-                    raise argparse.ArgumentTypeError(f'value must > {lower}')
-            else:
-                if not value >= lower:
-                    raise argparse.ArgumentTypeError(f'value must >= {lower}')
 
-        if upper is not None:
-            if upper_open:
-                if not value < upper:
-                    raise argparse.ArgumentTypeError(f'value must < {upper}')
-            else:
-                if not value <= upper:
-                    raise argparse.ArgumentTypeError(f'value must <= {upper}')
+def get_close_matches(word, possibilities, n=10, cutoff=0.1):
+    """同 difflib.get_close_matches，如有安裝 rapidfuzz 則採用之以加速
 
-        return value
+    相似度相同者，difflib 依字串反向排序，rapidfuzz 則依 possibilities 的順序，
+    故二者輸出順序（及 n 截斷時選出的項目）可能不同。
+    """
+    if process is None:
+        return difflib.get_close_matches(word, possibilities, n=n, cutoff=cutoff)
 
-    validator.__name__ = f'int{_bound_str(lower, upper, lower_open, upper_open)}'
-    return validator
+    matches = process.extract(word, possibilities, scorer=fuzz.ratio, limit=n, score_cutoff=cutoff * 100)
+    return [match[0] for match in matches]
+
+
+def format_combination(formulas, dosages):
+    """格式化方劑組合，如 '桂枝湯:6.0 芍藥甘草湯:3.0 (總計: 9.0)'"""
+    combo_str = ' '.join(['%s:%.1f' % item for item in zip(formulas, dosages)])
+    return '%s (總計: %.1f)' % (combo_str, sum(dosages))
 
 
 def search(database, composition, excludes=None, raw=False, **opts):
     excludes = set() if excludes is None else set(excludes)
 
-    target_composition = {}
+    target_composition = defaultdict(float)
     unknowns = {}
     if raw:
         for herb, amount in composition:
+            herb = sys.intern(herb)
             if herb in database.herbs:
-                target_composition[herb] = target_composition.get(herb, 0) + amount
+                target_composition[herb] += amount
             else:
                 unknowns[herb] = None
 
         combo_str = ''
     else:
         for formula, dosage in composition:
+            formula = sys.intern(formula)
             if formula in database:
                 if formula in database.cformulas:
                     excludes.add(formula)
-                adjusted = {herb: dosage * amount for herb, amount in database[formula].items()}
-                for herb, amount in adjusted.items():
-                    target_composition[herb] = target_composition.get(herb, 0) + amount
+                for herb, amount in database[formula].items():
+                    target_composition[herb] += dosage * amount
             else:
                 unknowns[formula] = None
 
-        combo_str = ' '.join(f'{formula}:{dosage:.1f}' for formula, dosage in composition)
-        total = sum(dosage for _, dosage in composition)
-        combo_str = f'{combo_str} (總計: {total:.1f})'
+        combo_str = format_combination([formula for formula, _ in composition], [dosage for _, dosage in composition])
+
+    target_composition = dict(target_composition)
 
     if unknowns:
-        candidates = database.herbs if raw else database
+        candidates = database.herb_names if raw else database.formula_names
         for unknown in unknowns:
-            suggestions = difflib.get_close_matches(unknown, candidates, n=10, cutoff=0.1)
+            # names containing or contained in the given one are likely its
+            # variants (e.g. without the trailing 湯/散); skip fuzzy matching
+            # if there are enough of them
+            suggestions = [name for name in candidates if unknown in name or name in unknown]
+            if len(suggestions) >= 3:
+                suggestions = suggestions[:10]
+            else:
+                suggestions = get_close_matches(unknown, candidates, n=10, cutoff=0.1)
             if suggestions:
                 yield f'資料庫尚未收錄「{unknown}」。你是不是想找: {", ".join(suggestions)}？'
             else:
@@ -174,34 +205,47 @@ def search(database, composition, excludes=None, raw=False, **opts):
     yield f'搜尋費時: {elapsed}'
     yield ''
 
+    herbs = database.herb_names
+    target_herbs = list(target_composition)
+    target_ids = np.fromiter((database.herb_index[herb] for herb in target_herbs), dtype=np.intp, count=len(target_herbs))
+    target_amounts = np.fromiter(target_composition.values(), dtype=np.float64, count=len(target_herbs))
+    is_target = np.zeros(len(herbs), dtype=bool)
+    is_target[target_ids] = True
+    indptr, formula_herb_ids, _ = database.composition_arrays
     for match in best_matches:
         match_percentage, combination, dosages = match
 
-        combined_composition = {}
-        for dosage, formula in zip(dosages, combination):
-            for herb, amount in database[formula].items():
-                combined_composition[herb] = combined_composition.get(herb, 0) + dosage * amount
+        combined_amounts = database.get_composition_vector(combination, dosages)
 
-        herbs_amount = sorted(combined_composition.items(), key=lambda item: (item[0] not in target_composition, item[0]))
+        # list every herb of the combination, including those with a zero amount
+        herb_ids = np.unique(np.concatenate([
+            formula_herb_ids[indptr[i]:indptr[i + 1]]
+            for i in (database.formula_index[formula] for formula in combination)
+        ]))
+
+        # target herbs first, then the others, each sorted by name
+        target_herbs_amount = []
+        other_herbs_amount = []
+        for i, flag, amount in zip(herb_ids.tolist(), is_target[herb_ids].tolist(), combined_amounts[herb_ids].tolist()):
+            (target_herbs_amount if flag else other_herbs_amount).append((herbs[i], amount))
+        target_herbs_amount.sort()
+        other_herbs_amount.sort()
 
         missing_herbs = {
-            herb: amount
-            for herb in target_composition
-            if (amount := target_composition.get(herb)) and not combined_composition.get(herb)
+            target_herbs[i]: target_amounts[i]
+            for i in np.flatnonzero((target_amounts != 0) & (combined_amounts[target_ids] == 0))
         }
 
-        combination_str = ' '.join(f'{formula}:{dosage:.1f}' for formula, dosage in zip(combination, dosages))
-        total = sum(dosages)
-        yield f'匹配度: {match_percentage:.2f}%，組合: {combination_str} (總計: {total:.1f})'
-        for herb, amount in herbs_amount:
-            if herb in target_composition:
-                herb = f'**{herb}**'
-            yield f'    {herb}: {amount:.2f}'
+        yield f'匹配度: {match_percentage:.2f}%，組合: {format_combination(combination, dosages)}'
+        for herb, amount in target_herbs_amount:
+            yield '    **%s**: %.2f' % (herb, amount)
+        for herb, amount in other_herbs_amount:
+            yield '    %s: %.2f' % (herb, amount)
 
         if missing_herbs:
             yield '尚缺藥物:'
             for herb, amount in missing_herbs.items():
-                yield f'    {herb}: {amount:.2f}'
+                yield '    %s: %.2f' % (herb, amount)
 
         yield ''
 
@@ -209,44 +253,81 @@ def search(database, composition, excludes=None, raw=False, **opts):
 def cmd_search(args):
     searcher.log.setLevel(args.verbosity)
     try:
-        database = searcher.FormulaDatabase.from_file(args.database)
+        database = searcher.FormulaDatabase.from_file(args.database, use_cache=True)
     except OSError:
         print(f'無法載入資料庫檔案: {args.database}')
         return
 
-    gen = search(database, args.items, args.excludes, args.raw, top_n=args.num,
+    if args.items:
+        _search_and_print(database, args.items, args)
+        return
+
+    # interactive mode: read queries line by line and reuse the loaded database
+    parse_item = name_value(bounded_float(0.1))
+    print("互動模式: 請輸入要搜尋的品項及劑量，例如 '補中益氣湯:6.0 桂枝:1.0'，輸入空行結束")
+    while True:
+        try:
+            line = input('> ')
+        except (EOFError, KeyboardInterrupt):
+            print()
+            break
+
+        if not line.strip():
+            break
+
+        try:
+            items = [parse_item(token) for token in line.split()]
+        except argparse.ArgumentTypeError as exc:
+            print(f'輸入格式錯誤: {exc}')
+            continue
+
+        _search_and_print(database, items, args)
+
+
+def _search_and_print(database, items, args):
+    gen = search(database, items, args.excludes, args.raw, top_n=args.num,
                  max_cformulas=args.max_cformulas, max_sformulas=args.max_sformulas,
                  min_cformula_dose=args.min_cformula_dose, min_sformula_dose=args.min_sformula_dose,
                  max_cformula_dose=args.max_cformula_dose, max_sformula_dose=args.max_sformula_dose,
                  penalty_factor=args.penalty, algorithm=args.algorithm,
                  beam_width_factor=args.beam_width_factor, beam_multiplier=args.beam_multiplier)
 
+    buf = []
     for msg in gen:
-        if msg is not None:
-            print(msg)
+        if msg is None:
+            sys.stdout.write(''.join(buf))
+            sys.stdout.flush()
+            buf = []
+            continue
+        buf.append(f'{msg}\n')
+    sys.stdout.write(''.join(buf))
+    sys.stdout.flush()
 
 
 def cmd_list(args):
     searcher.log.setLevel(args.verbosity)
     try:
-        database = searcher.FormulaDatabase.from_file(args.database)
+        database = searcher.FormulaDatabase.from_file(args.database, use_cache=True)
     except OSError:
         print(f'無法載入資料庫檔案: {args.database}')
         return
 
     if args.raw:
-        names = sorted({k for c in database.values() for k in c})
+        names = sorted(database.herbs)
     else:
         names = sorted(database)
 
     if args.keywords:
         keywords = set(args.keywords)
-        fn = any if args.any else all
-        for name in (n for n in names if fn(k in n for k in keywords)):
-            print(name)
-    else:
-        for name in names:
-            print(name)
+        if args.any:
+            match = re.compile('|'.join(re.escape(k) for k in keywords)).search
+            names = [n for n in names if match(n)]
+        else:
+            # check longer keywords first as they are more likely to miss
+            keywords = sorted(keywords, key=len, reverse=True)
+            names = [n for n in names if all(k in n for k in keywords)]
+
+    sys.stdout.write(''.join(f'{name}\n' for name in names))
 
 
 def cmd_gui(args):
@@ -255,9 +336,10 @@ def cmd_gui(args):
 
 
 def cmd_convert(args):
+    from . import converter
     converter.log.setLevel(args.verbosity)
     handler = converter.LicenseFileHandler()
-    handler.load_config(args.config)
+    handler.load_config(converter.DEFAULT_CONFIG_FILE if args.config is None else args.config)
     data = handler.load(args.file, use_unit_dosage=args.unit_dosage, filter_vendor=args.vendor)
     handler.dump(data, args.output)
 
@@ -292,9 +374,9 @@ def parse_args(argv=None):
     )
     parser_search.set_defaults(func=cmd_search)
     parser_search.add_argument(
-        'items', metavar='NAME:DOSE', nargs='+', action='store',
+        'items', metavar='NAME:DOSE', nargs='*', action='store',
         type=name_value(bounded_float(0.1)),
-        help="""要搜尋的科學中藥品項及劑量。例如 '補中益氣湯:6.0 桂枝:1.0'""",
+        help="""要搜尋的科學中藥品項及劑量。例如 '補中益氣湯:6.0 桂枝:1.0'。未指定時進入互動模式，載入資料庫後逐行讀取要搜尋的品項""",
     )
     parser_search.add_argument(
         '-r', '--raw', default=False, action='store_true',
@@ -442,8 +524,8 @@ def parse_args(argv=None):
         help="""儲存換算後的每克生藥含量""",
     )
     parser_convert.add_argument(
-        '-c', '--config', metavar='FILE', default=converter.DEFAULT_CONFIG_FILE, action='store',
-        help="""使用自訂的配置檔 (預設: %(default)s)""",
+        '-c', '--config', metavar='FILE', action='store',
+        help="""使用自訂的配置檔 (預設: 內建的 converter.yaml)""",
     )
 
     return parser.parse_args(argv)
@@ -2,6 +2,7 @@ import csv
 import logging
 import os
 import re
+from collections import defaultdict
 from decimal import Decimal
 
 import yaml
@@ -141,7 +142,7 @@ class LicenseFileHandler:
         return f'https://service.mohw.gov.tw/DOCMAP/CusSite/TCMLResultDetail.aspx?LICEWORDID=01&LICENUM={num}'
 
     def retrieve_composition(self, text):
-        comp = {}
+        comp = defaultdict(int)
         lines = text.split('\n')
 
         m = re.search(r'處方:.*?每\s*([\d.]*)\s*(?:gm?\s*)?(?:公?克\s*)?中?含有?', lines[0])
@@ -157,7 +158,7 @@ class LicenseFileHandler:
 
             name, dosage = self._retrieve_composition_line(lines, i)
             if name:
-                comp[name] = comp.get(name, 0) + dosage
+                comp[name] += dosage
 
         _i = i + 1
         for i in range(_i, len(lines)):
@@ -171,9 +172,9 @@ class LicenseFileHandler:
 
             name, dosage = self._retrieve_composition_line(lines, i)
             if name:
-                comp[name] = comp.get(name, 0) + dosage
+                comp[name] += dosage
 
-        return comp, unit_dosage
+        return dict(comp), unit_dosage
 
     def _retrieve_composition_line(self, lines, i):
         m = re.search(r'^(.*?)\s*\(([\d.]+)\s*(?:gm?|公?克)\)', lines[i])
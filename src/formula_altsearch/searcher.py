@@ -1,21 +1,32 @@
+import hashlib
 import heapq
 import logging
 import os
+import pickle
+import sys
 from abc import ABC, abstractmethod
-from contextlib import nullcontext
 from functools import cached_property
-from itertools import combinations
+from itertools import combinations, product
 from math import ceil, sqrt
 
 import numpy as np
 import yaml
-from scipy.optimize import minimize
 
 DEFAULT_DATAFILE = os.path.normpath(os.path.join(__file__, '..', 'database.yaml'))
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
+# use the libyaml based loader when available, which parses several times
+# faster than the pure Python one
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# directory to cache parsed database files
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'formula_altsearch',
+)
+
 undefined = object()
 
 
@@ -37,26 +48,87 @@ def find_best_matches(database, target_composition, top_n=None, algorithm='beam'
 
 class FormulaDatabase(dict):
     @classmethod
-    def from_file(cls, file):
+    def from_file(cls, file, use_cache=False):
+        """從 YAML 檔案載入資料庫
+
+        use_cache 為 True 時，將解析後的資料以 pickle 快取於 CACHE_DIR
+        ($XDG_CACHE_HOME/formula_altsearch，預設為 ~/.cache/formula_altsearch)，
+        檔案路徑、大小或修改時間改變時會重新解析，並刪除同一路徑的舊快取。
+        快取檔案會以 pickle 載入，請勿將 CACHE_DIR 設為他人可寫入的目錄。
+        """
         try:
             # file is a path-like object
-            _fh = open(file, 'r', encoding='utf-8')
+            stat = os.stat(file)
         except TypeError:
             # file is a file-like object
-            _fh = nullcontext(file)
+            return cls.from_dict(yaml.load(file, Loader=YamlLoader))
+
+        cache_file = cls._get_cache_file(file, stat) if use_cache else None
+
+        if cache_file:
+            try:
+                with open(cache_file, 'rb') as fh:
+                    data = pickle.load(fh)
+            except FileNotFoundError:
+                pass
+            except Exception as exc:
+                log.debug('無法讀取快取檔案 %s: %s', cache_file, exc)
+            else:
+                return cls.from_dict(data)
+
+        with open(file, 'r', encoding='utf-8') as fh:
+            data = yaml.load(fh, Loader=YamlLoader)
 
-        with _fh as fh:
-            data = yaml.safe_load(fh)
+        if cache_file:
+            try:
+                os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+                tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+                try:
+                    with open(tmp_file, 'wb') as fh:
+                        pickle.dump(data, fh, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp_file, cache_file)
+                finally:
+                    # a failed write leaves the temp file, which
+                    # _remove_stale_cache_files does not match
+                    if os.path.lexists(tmp_file):
+                        os.remove(tmp_file)
+            except OSError as exc:
+                log.debug('無法寫入快取檔案 %s: %s', cache_file, exc)
+            else:
+                cls._remove_stale_cache_files(cache_file)
 
         return cls.from_dict(data)
 
+    @staticmethod
+    def _get_cache_file(file, stat):
+        """取得資料庫檔案的快取路徑，以檔案路徑、大小及修改時間為索引
+
+        檔名為 db-<路徑雜湊值>-<大小>-<修改時間>.pickle，以便找出同一路徑的舊快取。
+        """
+        digest = hashlib.sha1(os.fsencode(os.path.abspath(file))).hexdigest()
+        return os.path.join(CACHE_DIR, f'db-{digest}-{stat.st_size}-{stat.st_mtime_ns}.pickle')
+
+    @staticmethod
+    def _remove_stale_cache_files(cache_file):
+        """刪除與 cache_file 同一資料庫檔案路徑的其他快取檔案"""
+        cache_dir, name = os.path.split(cache_file)
+        prefix = name[:name.index('-', len('db-')) + 1]
+        for entry in os.scandir(cache_dir):
+            if entry.name.startswith(prefix) and entry.name.endswith('.pickle') and entry.name != name:
+                try:
+                    os.remove(entry.path)
+                except OSError as exc:
+                    log.debug('無法刪除舊快取檔案 %s: %s', entry.path, exc)
+
     @classmethod
     def from_dict(cls, data):
         rv = {}
 
         for _item in data:
             name = _item['name']
-            key = _item['key']
+            # intern names so that dict lookups across formulas and user
+            # input of the same name can compare by identity
+            key = sys.intern(_item['key'])
             if key in rv:
                 log.warning('%s 使用了重複的索引值 %s，將被忽略', repr(name), repr(key), )
                 continue
@@ -64,7 +136,7 @@ class FormulaDatabase(dict):
             unit_dosage = _item.get('unit_dosage', 1)
             item = rv[key] = {}
             for herb, amount in _item['composition'].items():
-                item[herb] = amount / unit_dosage
+                item[sys.intern(herb)] = amount / unit_dosage
 
         return cls(rv)
 
@@ -98,6 +170,77 @@ class FormulaDatabase(dict):
         self.__dict__['sformulas'] = sformulas
         self.__dict__['herbs'] = herbs
 
+    @cached_property
+    def herb_names(self):
+        return tuple(self.herbs)
+
+    @cached_property
+    def formula_names(self):
+        return tuple(self)
+
+    @cached_property
+    def herb_index(self):
+        return {herb: i for i, herb in enumerate(self.herbs)}
+
+    @cached_property
+    def formula_index(self):
+        return {formula: i for i, formula in enumerate(self)}
+
+    @cached_property
+    def composition_arrays(self):
+        """各方劑組成的壓縮列 (CSR) 陣列
+
+        回傳 (indptr, herb_ids, amounts)：第 i 個方劑的組成中藥索引值及劑量分別
+        為 herb_ids[indptr[i]:indptr[i + 1]] 及 amounts[indptr[i]:indptr[i + 1]]，
+        中藥索引值對應 herb_index。
+        """
+        herb_index = self.herb_index
+        indptr = np.zeros(len(self) + 1, dtype=np.intp)
+        np.cumsum([len(comp) for comp in self.values()], out=indptr[1:])
+        herb_ids = np.fromiter(
+            (herb_index[herb] for comp in self.values() for herb in comp),
+            dtype=np.intp, count=indptr[-1],
+        )
+        amounts = np.fromiter(
+            (amount for comp in self.values() for amount in comp.values()),
+            dtype=np.float64, count=indptr[-1],
+        )
+        return indptr, herb_ids, amounts
+
+    @cached_property
+    def herb_formulas(self):
+        """各中藥對應含有該中藥之方劑的反向索引，方劑依資料庫順序排列"""
+        herb_formulas = {}
+        for formula, comp in self.items():
+            for herb in comp:
+                herb_formulas.setdefault(herb, []).append(formula)
+        return herb_formulas
+
+    @cached_property
+    def formula_matrix(self):
+        """各方劑組成的稠密矩陣
+
+        formula_matrix[formula_index[formula], herb_index[herb]] 為方劑中該中藥之含量。
+        """
+        indptr, herb_ids, amounts = self.composition_arrays
+        matrix = np.zeros((len(self), len(self.herbs)))
+        matrix[np.repeat(np.arange(len(self)), np.diff(indptr)), herb_ids] = amounts
+        return matrix
+
+    def get_composition_vector(self, formulas, dosages):
+        """計算方劑組合的中藥劑量，回傳以 herb_index 為索引的陣列"""
+        indptr, herb_ids, amounts = self.composition_arrays
+        formula_ids = np.fromiter((self.formula_index[f] for f in formulas), dtype=np.intp)
+        starts = indptr[formula_ids]
+        lengths = indptr[formula_ids + 1] - starts
+
+        # gather the slices of all formulas at once:
+        # positions = starts[k] + (0, 1, ..., lengths[k] - 1) for each k
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+        weights = amounts[positions] * np.repeat(np.asarray(dosages, dtype=np.float64), lengths)
+        return np.bincount(herb_ids[positions], weights=weights, minlength=len(self.herbs))
+
 
 class FormulaSearcher(ABC):
     DEFAULT_TOP_N = 5
@@ -105,6 +248,12 @@ class FormulaSearcher(ABC):
     def __init__(self, database):
         self.database = database
 
+    @cached_property
+    def indexed_database(self):
+        """快取索引及矩陣的 FormulaDatabase，若 database 為一般 dict 則轉換之"""
+        database = self.database
+        return database if isinstance(database, FormulaDatabase) else FormulaDatabase(database)
+
     def _set_context(
         self, target_composition, excludes=None, top_n=None, *,
         max_cformulas=2, max_sformulas=2,
@@ -113,7 +262,7 @@ class FormulaSearcher(ABC):
         penalty_factor=2.0, places=1,
     ):
         self.target_composition = target_composition
-        self.excludes = set() if excludes is None else excludes
+        self.excludes = frozenset() if excludes is None else frozenset(excludes)
         self.max_cformulas = max_cformulas
         self.max_sformulas = max_sformulas
         self.cformula_bounds = (min_cformula_dose, max_cformula_dose)
@@ -130,11 +279,19 @@ class FormulaSearcher(ABC):
         cformulas = {}
         sformulas = {}
         herb_sformulas = {}
-        for item, composition in self.database.items():
-            if item in self.excludes:
-                continue
-            if not any(self.target_composition.get(herb, 0) for herb in composition):
-                continue
+
+        # collect formulas having any target herb from the inverted index,
+        # in the database order
+        database = self.indexed_database
+        herb_formulas = database.herb_formulas
+        related = set()
+        for herb, amount in self.target_composition.items():
+            if amount and herb in herb_formulas:
+                related.update(herb_formulas[herb])
+        related.difference_update(self.excludes)
+
+        for item in sorted(related, key=database.formula_index.__getitem__):
+            composition = database[item]
             if len(composition) > 1:
                 cformulas[item] = None
             else:
@@ -145,6 +302,82 @@ class FormulaSearcher(ABC):
         self.sformulas = sformulas
         self.herb_sformulas = herb_sformulas
 
+        self._compute_formula_matrix()
+
+    def _compute_formula_matrix(self):
+        """將各方劑組成轉為矩陣，以向量化計算組合劑量與目標組成的差異
+
+        formula_matrix[formula_index[formula], herb_index[herb]] 為方劑中該中藥之含量。
+        """
+        # the matrix of the database does not depend on the target, and is
+        # cached by FormulaDatabase across searches
+        database = self.indexed_database
+
+        herb_index = database.herb_index
+        formula_index = database.formula_index
+        matrix = database.formula_matrix
+
+        # append columns for target herbs not in any formula
+        extra_herbs = [herb for herb in self.target_composition if herb not in herb_index]
+        if extra_herbs:
+            herb_index = herb_index.copy()
+            for herb in extra_herbs:
+                herb_index[herb] = len(herb_index)
+            matrix = np.hstack((matrix, np.zeros((len(formula_index), len(extra_herbs)))))
+
+        self.herb_index = herb_index
+        self.formula_index = formula_index
+        self.formula_matrix = matrix
+        self.target_vector, self.weight_vector, _ = self._compute_target_vectors(self.target_composition)
+
+        # pre-weight for the default target so that each solve only needs to
+        # gather the rows of the combo
+        self.weighted_formula_matrix = matrix * self.weight_vector
+        self.weighted_target_vector = self.target_vector * self.weight_vector
+
+        self.target_herbs = tuple(self.target_composition)
+        self.target_sformula_mask = np.fromiter(
+            (h in self.herb_sformulas for h in self.target_herbs), dtype=bool, count=len(self.target_herbs))
+        self.target_herb_ids = np.fromiter(
+            (herb_index[h] for h in self.target_composition), dtype=np.intp, count=len(self.target_composition))
+        self.target_amounts = np.fromiter(
+            self.target_composition.values(), dtype=np.float64, count=len(self.target_composition))
+
+        # dosage bounds of each formula, with equal bounds widened as
+        # lsq_linear requires lb < ub (treated as a fixed dosage)
+        lower = np.full(len(formula_index), self.cformula_bounds[0], dtype=np.float64)
+        upper = np.full(len(formula_index), self.cformula_bounds[1], dtype=np.float64)
+        for formula in self.sformulas:
+            lower[formula_index[formula]], upper[formula_index[formula]] = self.sformula_bounds
+        self.lower_bounds = lower
+        self.upper_bounds = np.where(upper == lower, np.nextafter(upper, np.inf), upper)
+
+        # rows and norms of the related cformulas for vectorized heuristic scoring
+        self.cformula_names = tuple(self.cformulas)
+        self.cformula_ids = np.fromiter(
+            (formula_index[f] for f in self.cformula_names), dtype=np.intp, count=len(self.cformula_names))
+        self.cformula_matrix = self.weighted_formula_matrix[self.cformula_ids]
+        self.cformula_norms = np.linalg.norm(self.cformula_matrix, axis=1)
+
+    def _compute_target_vectors(self, target_composition):
+        """回傳以 herb_index 為索引的目標劑量及權重向量
+
+        目標組成的中藥權重為 1，其他中藥為 penalty_factor。另外回傳不在
+        herb_index 中的目標中藥劑量平方和，其組合劑量必為 0。
+        """
+        target = np.zeros(len(self.herb_index))
+        weights = np.full(len(self.herb_index), self.penalty_factor, dtype=np.float64)
+        extra = 0.0
+        for herb, amount in target_composition.items():
+            try:
+                i = self.herb_index[herb]
+            except KeyError:
+                extra += amount ** 2
+                continue
+            target[i] = amount
+            weights[i] = 1.0
+        return target, weights, extra
+
     def find_best_matches(self, top_n=None, *args, **kwargs):
         top_n = self.DEFAULT_TOP_N if top_n is None else top_n
         gen = self.find_unique_matches(*args, top_n=top_n, **kwargs)
@@ -192,12 +425,13 @@ class FormulaSearcher(ABC):
     def generate_combinations(self):
         pass
 
-    def get_formula_composition(self, formulas, dosages):
-        composition = {}
-        for formula, dosage in zip(formulas, dosages):
-            for herb, amount in self.database[formula].items():
-                composition[herb] = composition.get(herb, 0) + amount * dosage
-        return composition
+    def _calculate_remaining_amounts(self, combo, dosages):
+        """回傳目標組成各中藥扣除組合劑量後的剩餘劑量，依 target_composition 排序"""
+        remaining = self.target_amounts
+        if combo:
+            rows = self.formula_matrix[[self.formula_index[f] for f in combo]]
+            remaining = remaining - np.asarray(dosages, dtype=np.float64) @ rows[:, self.target_herb_ids]
+        return remaining
 
     def calculate_variance(self, composition):
         return sqrt(sum(amount**2 for amount in composition.values()))
@@ -211,45 +445,103 @@ class FormulaSearcher(ABC):
 
         非目標組成的中藥其貢獻度另外乘上 penalty_factor。
 
-        註：亦可改為以 delta^2 作為最小化目標，此即殘差平方和 (sum of squared
-        residuals, SSR)，可於迭代時省略開平方的開銷，且有專門最佳化過的
-        scipy.optimize.lsq_linear 函數及演算法可利用，但須全面把數據向量化，代
-        價是記憶體開銷較大（大約為資料庫總方劑數 * 總中藥數 * N），且需全面改
-        用較難理解的矩陣運算，考量實務上 beam search 速度已夠快，暫無必要進一
-        步最佳化。目前實測 scipy.optimize.minimize 處理 delta 比 SSR 快，可能
-        是對此演算法而言一次函數在目標值附近比較容易估算梯度所致，因此這裡仍採
-        用 delta。
+        註：求解最佳劑量時改以 delta^2，即殘差平方和 (sum of squared residuals,
+        SSR) 為最小化目標，見 find_best_dosages；此函數用於計算指定劑量（如四捨
+        五入後）的差異值。
         """
-        target = self.target_composition if target_composition is None else target_composition
-        combined_composition = self.get_formula_composition(combo, x)
-
-        delta = 0
-        for herb, target_amount in target.items():
-            combined_amount = combined_composition.get(herb, 0)
-            delta += (target_amount - combined_amount) ** 2
+        matrix, target, extra = self._get_weighted_system(combo, target_composition)
+        residuals = np.asarray(x, dtype=np.float64) @ matrix - target
+        return sqrt(residuals @ residuals + extra)
 
-        for herb, amount in combined_composition.items():
-            if herb not in target:
-                delta += (amount * self.penalty_factor) ** 2
+    def _get_weighted_system(self, combo, target_composition=None):
+        """回傳方劑組合的加權組成矩陣、加權目標向量，及不在 herb_index 中的目標
+        中藥劑量平方和"""
+        indexes = [self.formula_index[formula] for formula in combo]
+        if target_composition is None:
+            return self.weighted_formula_matrix[indexes], self.weighted_target_vector, 0.0
 
-        return sqrt(delta)
+        target, weights, extra = self._compute_target_vectors(target_composition)
+        return self.formula_matrix[indexes] * weights, target * weights, extra
 
     def find_best_dosages(self, combo, target_composition=None, *, initial_guess=None,
                           bounds=None, options=None):
-        initial_guess = np.ones(len(combo)) if initial_guess is None else initial_guess
-        bounds = [
-            self.sformula_bounds if f in self.sformulas else self.cformula_bounds
-            for f in combo
-        ] if bounds is None else bounds
-        options = {
-            'ftol': 10 ** (-self.places - 2),
-            'disp': False,
-        } if options is None else options
-        result = minimize(self.calculate_delta, initial_guess, args=(combo, target_composition),
-                          method='SLSQP', bounds=bounds, options=options)
+        """計算方劑組合與目標組成差異值最小的劑量，回傳 (劑量, 差異值)
+
+        最小化 delta 等同於在劑量上下限內最小化加權殘差平方和，即有界線性最小
+        平方問題，以 scipy.optimize.lsq_linear 的 BVLS 演算法直接求得精確解；
+        一或二個方劑時則以封閉解求得，以省去呼叫 lsq_linear 的額外負擔。
+
+        options 為傳給 lsq_linear 的額外參數，僅在三個以上方劑時作用；
+        initial_guess 對此演算法無作用，僅為相容而保留。
+        """
+        matrix, target, extra = self._get_weighted_system(combo, target_composition)
+
+        if bounds is None:
+            indexes = [self.formula_index[formula] for formula in combo]
+            lb, ub = self.lower_bounds[indexes], self.upper_bounds[indexes]
+        else:
+            lb, ub = np.array(bounds, dtype=np.float64).reshape(-1, 2).T
+            # lsq_linear requires lb < ub; treat equal bounds as a fixed dosage
+            ub = np.where(ub == lb, np.nextafter(ub, np.inf), ub)
+
+        if len(combo) <= 2:
+            x = self._solve_small_dosages(matrix, target, lb, ub)
+            residuals = x @ matrix - target
+            return x, sqrt(residuals @ residuals + extra)
+
+        # scipy.optimize takes most of the import time of this package; load
+        # it only when it is actually needed
+        from scipy.optimize import lsq_linear
+
+        # herbs in neither the combo nor the target have no residual
+        cols = np.flatnonzero(matrix.any(axis=0) | (target != 0))
+        result = lsq_linear(matrix[:, cols].T, target[cols],
+                            bounds=(lb, ub), method='bvls', **({} if options is None else options))
         if not result.success:
             raise ValueError(f'Unable to find best dosages: {result.message}')
-        return result.x, result.fun
+        return result.x, sqrt(2 * result.cost + extra)
+
+    @staticmethod
+    def _solve_small_dosages(matrix, target, lb, ub):
+        """以封閉解求一或二個方劑的有界線性最小平方劑量
+
+        單一方劑時，最佳解為目標在其組成上的投影，再限制於上下限內。二個方劑時，
+        若無限制的最佳解在上下限內即為所求，否則最佳解必在邊界上，即固定其中一
+        方劑劑量為上限或下限，另一方劑依單一方劑方式求解，取四者中殘差最小者。
+        """
+        gram = (matrix @ matrix.T).tolist()
+        proj = (matrix @ target).tolist()
+        lb = lb.tolist()
+        ub = ub.tolist()
+
+        def solve_one(j, b):
+            # minimize gram[j][j] * x ** 2 - 2 * b * x within bounds
+            x = b / gram[j][j] if gram[j][j] else lb[j]
+            return min(max(x, lb[j]), ub[j])
+
+        if len(proj) == 1:
+            return np.array([solve_one(0, proj[0])])
+
+        (g00, g01), (_, g11) = gram
+        det = g00 * g11 - g01 * g01
+        if det > 1e-12 * g00 * g11:
+            x0 = (g11 * proj[0] - g01 * proj[1]) / det
+            x1 = (g00 * proj[1] - g01 * proj[0]) / det
+            if lb[0] <= x0 <= ub[0] and lb[1] <= x1 <= ub[1]:
+                return np.array([x0, x1])
+
+        best, best_cost = None, None
+        for i, j in ((0, 1), (1, 0)):
+            for v in (lb[i], ub[i]):
+                x = [0.0, 0.0]
+                x[i] = v
+                x[j] = solve_one(j, proj[j] - g01 * v)
+                # the residual sum of squares less the constant |target|^2
+                cost = (g00 * x[0] * x[0] + 2 * g01 * x[0] * x[1] + g11 * x[1] * x[1]
+                        - 2 * (proj[0] * x[0] + proj[1] * x[1]))
+                if best_cost is None or cost < best_cost:
+                    best, best_cost = x, cost
+        return np.array(best)
 
     def calculate_match_ratio(self, delta, variance=None):
         """將待測劑量組成與目標劑量組成的差異值轉化為匹配度
@@ -266,11 +558,19 @@ class FormulaSearcher(ABC):
         return (1.0 - delta / variance) if variance != 0 else 1.0
 
     def calculate_match(self, combo, **opts):
+        combo = tuple(combo)
         key = frozenset(combo)
         try:
-            result = self.evaluate_cache[key]
+            cached_combo, result = self.evaluate_cache[key]
         except KeyError:
             result = None
+        else:
+            # the same formulas may come in another order; reorder the
+            # dosages to match the given combo
+            if cached_combo != combo and not isinstance(result, Exception):
+                dosages, delta, match_pct = result
+                dosages = dosages[[cached_combo.index(f) for f in combo]]
+                result = dosages, delta, match_pct
 
         if result is None:
             log.debug('精算: %s', combo)
@@ -283,7 +583,7 @@ class FormulaSearcher(ABC):
             else:
                 result = (), 0.0, 100.0
 
-            self.evaluate_cache[key] = result
+            self.evaluate_cache[key] = combo, result
 
         if isinstance(result, Exception):
             raise result
@@ -301,54 +601,47 @@ class FormulaSearcher(ABC):
         match_pct = self.calculate_match_ratio(delta, variance) * 100
         return dosages, delta, match_pct
 
-    def evaluate_combination(self, combo, *, initial_guess=None):
+    def evaluate_combination(self, combo):
         # raise ValueError if unable to find minimal dosages
-        dosages, delta, match_pct = self.calculate_match(combo, initial_guess=initial_guess)
+        dosages, delta, match_pct = self.calculate_match(combo)
         log.debug('估值: %s %s: %.3f (%.2f%%)', combo, dosages, delta, match_pct)
 
         # remove formulas with 0 dosage
         fixed_combo, fixed_dosages = combo, dosages
-        _fixed_combo = None
-        while fixed_combo != _fixed_combo:
-            _fixed_combo = fixed_combo
+        non_zero_mask = fixed_dosages != 0
+        if not np.all(non_zero_mask):
+            # re-solve once without them, as the rest may fit better
+            fixed_combo = tuple(f for f, non_zero in zip(fixed_combo, non_zero_mask) if non_zero)
+            fixed_dosages = fixed_dosages[non_zero_mask]
+            fixed_dosages, delta, match_pct = self.calculate_match(fixed_combo)
 
+            # a formula rounded to 0 only now contributes nothing, and can be
+            # stripped without changing the result
             non_zero_mask = fixed_dosages != 0
-            if np.all(non_zero_mask):
-                break
-
-            fixed_combo = tuple(np.array(fixed_combo, dtype=object)[non_zero_mask])
-            fixed_dosages = fixed_dosages[non_zero_mask]
-            fixed_dosages, delta, match_pct = self.calculate_match(fixed_combo, initial_guess=fixed_dosages)
+            if not np.all(non_zero_mask):
+                fixed_combo = tuple(f for f, non_zero in zip(fixed_combo, non_zero_mask) if non_zero)
+                fixed_dosages = fixed_dosages[non_zero_mask]
 
-        log.debug('校正: %s %s: %.3f (%.2f%%)', fixed_combo, np.round(fixed_dosages, self.places), delta, match_pct)
+        log.debug('校正: %s %s: %.3f (%.2f%%)', fixed_combo, fixed_dosages, delta, match_pct)
 
         return fixed_combo, fixed_dosages, match_pct
 
     def generate_combinations_for_sformulas(self, combo, dosages):
-        combined_composition = self.get_formula_composition(combo, dosages)
-        remaining_composition = {
-            herb: amount - combined_composition.get(herb, 0)
-            for herb, amount in self.target_composition.items()
-        }
+        remaining = self._calculate_remaining_amounts(combo, dosages)
 
-        weighted_herbs = sorted(remaining_composition.items(), key=lambda item: -item[1])
-        candidate_herbs = tuple(
-            herb for herb, amount in weighted_herbs
-            if herb in self.herb_sformulas and np.round(amount, self.places) > 0
-        )
-        candidate_herbs_count = len(candidate_herbs)
-
-        stack = [(0, combo)]
-        while stack:
-            n, combo = stack.pop()
-            if n >= self.max_sformulas or n >= candidate_herbs_count:
-                if combo:
-                    yield combo
-                continue
+        # candidate herbs by descending remaining amount (stable for ties)
+        candidates = np.flatnonzero(self.target_sformula_mask & (np.round(remaining, self.places) > 0))
+        candidates = candidates[np.argsort(-remaining[candidates], kind='stable')][:self.max_sformulas]
 
-            herb = candidate_herbs[n]
-            for sformula in reversed(self.herb_sformulas[herb]):
-                stack.append((n + 1, combo + (sformula,)))
+        # pick one sformula for each of the top n candidate herbs, for n up to
+        # max_sformulas, as supplementing a herb whose remaining amount is
+        # little may fit worse than leaving it
+        pools = [self.herb_sformulas[self.target_herbs[i]] for i in candidates]
+        for n in range(len(pools) + 1):
+            for sformulas in product(*pools[:n]):
+                new_combo = combo + sformulas
+                if new_combo:
+                    yield new_combo
 
 
 class ExhaustiveFormulaSearcher(FormulaSearcher):
@@ -384,11 +677,12 @@ class BeamFormulaSearcher(FormulaSearcher):
         candidates = [(0, 100.0, (), ())]
         for depth in range(self.max_cformulas):
             if depth < self.max_cformulas - 1:
-                candidates = heapq.nlargest(
-                    self.beam_width,
-                    self.generate_unique_combinations_at_depth(depth, candidates),
-                    key=lambda x: x[1],
-                )
+                candidates = list(self.generate_unique_combinations_at_depth(depth, candidates))
+                scores = np.fromiter((x[1] for x in candidates), dtype=np.float64, count=len(candidates))
+
+                # stable sort to keep the generated order for ties, as heapq.nlargest
+                order = np.argsort(-scores, kind='stable')[:self.beam_width]
+                candidates = [candidates[i] for i in order]
                 log.debug('第 %i 層候選: %s', depth, [x[2] for x in candidates])
             else:
                 candidates = self.generate_unique_combinations_at_depth(depth, candidates)
@@ -433,12 +727,10 @@ class BeamFormulaSearcher(FormulaSearcher):
             else:
                 gen = self.generate_ramaining_candidates(combo)
 
-            _new_dosages = np.append(dosages, (1.0,))
             for formula in gen:
                 new_combo = combo + (formula,)
                 try:
-                    new_combo, new_dosages, match_pct = self.evaluate_combination(
-                        new_combo, initial_guess=_new_dosages)
+                    new_combo, new_dosages, match_pct = self.evaluate_combination(new_combo)
                 except ValueError as exc:
                     log.debug('略過錯誤項目: %s', new_combo, exc)
                     continue
@@ -457,22 +749,21 @@ class BeamFormulaSearcher(FormulaSearcher):
             log.debug('略過擴展: %s', combo)
             return
 
-        candidate_formulas = heapq.nlargest(
-            quota,
-            self.generate_ramaining_candidates(combo),
-            key=lambda f: self._calculate_formula_score(f, remaining_map),
-        )
+        scores = self._calculate_cformula_scores(remaining_map)
+        candidates = np.flatnonzero(~np.isin(self.cformula_ids, [self.formula_index[f] for f in combo]))
 
-        for formula in candidate_formulas:
-            log.debug('快捷輸出: %s', formula)
+        # stable sort to keep the database order for ties, as heapq.nlargest
+        order = np.argsort(-scores[candidates], kind='stable')[:quota]
+        for i in candidates[order]:
+            formula = self.cformula_names[i]
+            log.debug('快捷輸出: %s: %.3f', formula, scores[i])
             yield formula
 
     def _calculate_remaining_map(self, combo, dosages):
-        combined_composition = self.get_formula_composition(combo, dosages)
         remaining_composition = {
             herb: fixed_amount
-            for herb, amount in self.target_composition.items()
-            if (fixed_amount := np.round(amount - combined_composition.get(herb, 0), self.places)) > 0
+            for herb, amount in zip(self.target_herbs, self._calculate_remaining_amounts(combo, dosages))
+            if (fixed_amount := np.round(amount, self.places)) > 0
         }
         total = sum(remaining_composition.values())
         return {
@@ -480,7 +771,7 @@ class BeamFormulaSearcher(FormulaSearcher):
             for herb, amount in remaining_composition.items()
         }
 
-    def _calculate_formula_score(self, formula, remaining_map):
+    def _calculate_cformula_scores(self, remaining_map, formulas=None):
         """計算複方評分，以估算其是否適合填補目前的剩餘中藥組成
 
         評分方式為餘弦相似性 (cosine similarity)：將待測中藥組成與目標中藥組成
@@ -489,30 +780,18 @@ class BeamFormulaSearcher(FormulaSearcher):
         為 0 度，此時此複方（按特定比例縮放後）可完美填補剩餘中藥組成；值為 0
         表示二者夾角為 90 度，此時此複方不可能填補剩餘中藥組成。
 
-        餘弦相似性與數值大小無關，用「劑量組成」或「劑量組成比」皆可計算，理論上
-        前者可省略把劑量轉換成比例的運算，但實測後者較快，可能是因後者的值固定在
-        0~1，浮點數運算在底層處理器較易最佳化所致。
+        餘弦相似性與數值大小無關，故直接以已加權的劑量組成矩陣一次計算所有方劑，
+        不必轉換為組成比。formulas 預設為所有相關複方，回傳依其排序的陣列。
         """
-        composition = self.database[formula]
-        herbs = set(composition)
-        herbs.update(remaining_map)
-
-        try:
-            total = sum(composition.values())
-            sum_ab = 0.0
-            sum_a_sq = 0.0
-            sum_b_sq = 0.0
-            for herb in herbs:
-                a = composition.get(herb, 0.0) / total
-                if herb not in self.target_composition:
-                    a *= self.penalty_factor
-                b = remaining_map.get(herb, 0.0)
-                sum_ab += a * b
-                sum_a_sq += a ** 2.0
-                sum_b_sq += b ** 2.0
-            score = sum_ab / (sqrt(sum_a_sq) * sqrt(sum_b_sq))
-        except ZeroDivisionError:
-            return 0.0
-
-        log.debug('快捷估值: %s: %.3f', formula, score)
-        return score
+        if formulas is None:
+            matrix, formula_norms = self.cformula_matrix, self.cformula_norms
+        else:
+            matrix = self.weighted_formula_matrix[[self.formula_index[f] for f in formulas]]
+            formula_norms = np.linalg.norm(matrix, axis=1)
+
+        cols = np.fromiter(
+            (self.herb_index[herb] for herb in remaining_map), dtype=np.intp, count=len(remaining_map))
+        values = np.fromiter(remaining_map.values(), dtype=np.float64, count=len(remaining_map))
+        dots = matrix[:, cols] @ values
+        norms = formula_norms * np.linalg.norm(values)
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
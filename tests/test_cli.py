@@ -1,14 +1,65 @@
+import argparse
 import unittest
 from io import StringIO
 from types import SimpleNamespace
 from unittest import mock
 
-from formula_altsearch import cli
+from formula_altsearch import cli, converter
 
 DATABASE_SAMPLE = cli.searcher.FormulaDatabase({'桂枝湯': {'桂枝': 3, '白芍': 2}, '桂枝': {'桂枝': 4}})
 DATABASE_SAMPLE2 = cli.searcher.FormulaDatabase({'桂枝湯': {'桂枝': 3, '白芍': 2}, '芍藥甘草湯': {'白芍': 2, '炙甘草': 2}})
 
 
+class TestCJKRawDescriptionHelpFormatter(unittest.TestCase):
+    def test_split_lines(self):
+        formatter = cli.CJKRawDescriptionHelpFormatter('prog')
+        self.assertEqual(formatter._split_lines('中文ab中\nxy', 5), ['中文a', 'b中', 'xy'])
+        self.assertEqual(formatter._split_lines('abcdef', 3), ['abc', 'def'])
+        self.assertEqual(formatter._split_lines('', 3), [])
+        self.assertEqual(formatter._split_lines('ab\n\ncdef\n', 3), ['ab', '', 'cde', 'f'])
+        self.assertEqual(formatter._split_lines('中\n\nab\n', 3), ['中', '', 'ab'])
+
+
+class TestValidators(unittest.TestCase):
+    def test_bounded_float(self):
+        validator = cli.bounded_float(0.1, 50)
+        self.assertEqual(validator.__name__, 'float[0.1, 50]')
+        self.assertEqual(validator('0.1'), 0.1)
+        self.assertEqual(validator('50'), 50.0)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('0.09')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('51')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('abc')
+
+    def test_bounded_int(self):
+        validator = cli.bounded_int(0, 10, lower_open=True, upper_open=True)
+        self.assertEqual(validator.__name__, 'int(0, 10)')
+        self.assertEqual(validator('1'), 1)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('0')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('10')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('1.5')
+
+        validator = cli.bounded_int(upper=5)
+        self.assertEqual(validator.__name__, 'int(∞, 5]')
+
+    def test_name_value(self):
+        validator = cli.name_value(cli.bounded_float(0.1))
+        self.assertEqual(validator.__name__, 'name_value(float[0.1, ∞))')
+        self.assertEqual(validator('桂枝湯:3'), ('桂枝湯', 3.0))
+        self.assertEqual(validator('a:b:2'), ('a:b', 2.0))
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('桂枝湯')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('桂枝湯:')
+        with self.assertRaises(argparse.ArgumentTypeError):
+            validator('桂枝湯:0')
+
+
 class TestCmdSearch(unittest.TestCase):
     @mock.patch('sys.stdout', new_callable=StringIO)
     @mock.patch.object(cli, 'search', wraps=cli.search)
@@ -32,7 +83,7 @@ class TestCmdSearch(unittest.TestCase):
             beam_width_factor=0.5,
             beam_multiplier=2.0,
         ))
-        m_load.assert_called_once_with('custom_db.yaml')
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
         m_search.assert_called_once_with(
             m_load.return_value, [('桂枝湯', 3)], [], False,
             top_n=6,
@@ -66,7 +117,7 @@ class TestCmdSearch(unittest.TestCase):
             beam_width_factor=0.5,
             beam_multiplier=2.0,
         ))
-        m_load.assert_called_once_with('custom_db.yaml')
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
         m_search.assert_called_once_with(
             m_load.return_value, [('麻黃湯', 3)], [], False,
             top_n=6,
@@ -101,7 +152,7 @@ class TestCmdSearch(unittest.TestCase):
             beam_width_factor=0.5,
             beam_multiplier=2.0,
         ))
-        m_load.assert_called_once_with('custom_db.yaml')
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
         m_search.assert_called_once_with(
             m_load.return_value, [('桂枝湯', 3), ('桂枝', 1)], [], False,
             top_n=6,
@@ -135,7 +186,7 @@ class TestCmdSearch(unittest.TestCase):
             beam_width_factor=0.5,
             beam_multiplier=2.0,
         ))
-        m_load.assert_called_once_with('custom_db.yaml')
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
         m_search.assert_called_once_with(
             m_load.return_value, [('桂枝湯', 3), ('白芍', 1), ('生薑', 1)], [], False,
             top_n=6,
@@ -170,7 +221,7 @@ class TestCmdSearch(unittest.TestCase):
             beam_width_factor=0.5,
             beam_multiplier=2.0,
         ))
-        m_load.assert_called_once_with('custom_db.yaml')
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
         m_search.assert_called_once_with(
             m_load.return_value, [('桂枝', 4), ('白芍', 2)], [], True,
             top_n=10,
@@ -204,7 +255,7 @@ class TestCmdSearch(unittest.TestCase):
             beam_width_factor=0.5,
             beam_multiplier=2.0,
         ))
-        m_load.assert_called_once_with('custom_db.yaml')
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
         m_search.assert_called_once_with(
             m_load.return_value, [('桂枝', 4), ('生薑', 3), ('炙甘草', 2)], [], True,
             top_n=10,
@@ -217,6 +268,37 @@ class TestCmdSearch(unittest.TestCase):
         )
         self.assertRegex(m_stdout.getvalue(), r'資料庫尚未收錄')
 
+    @mock.patch('sys.stdout', new_callable=StringIO)
+    @mock.patch('builtins.input', side_effect=['桂枝湯:3', '桂枝湯', '桂枝:4 生薑:3', EOFError])
+    @mock.patch.object(cli, 'search', wraps=cli.search)
+    @mock.patch.object(cli.searcher.FormulaDatabase, 'from_file', return_value=DATABASE_SAMPLE)
+    def test_cmd_search_interactive(self, m_load, m_search, m_input, m_stdout):
+        cli.cmd_search(SimpleNamespace(
+            verbosity=50,
+            database='custom_db.yaml',
+            items=[],
+            raw=False,
+            algorithm='exhaustive',
+            max_cformulas=2,
+            max_sformulas=3,
+            min_cformula_dose=1.0,
+            min_sformula_dose=0.3,
+            max_cformula_dose=50.0,
+            max_sformula_dose=50.0,
+            penalty=3,
+            num=6,
+            excludes=[],
+            beam_width_factor=0.5,
+            beam_multiplier=2.0,
+        ))
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
+        self.assertEqual(m_input.call_count, 4)
+        self.assertEqual([c.args[1] for c in m_search.call_args_list], [
+            [('桂枝湯', 3.0)],
+            [('桂枝', 4.0), ('生薑', 3.0)],
+        ])
+        self.assertRegex(m_stdout.getvalue(), r'輸入格式錯誤')
+
     @mock.patch('sys.stdout', new_callable=StringIO)
     @mock.patch.object(cli.searcher, 'find_best_matches', wraps=cli.searcher.find_best_matches)
     def test_search_herbs(self, m_find, m_stdout):
@@ -241,13 +323,134 @@ class TestCmdSearch(unittest.TestCase):
             excludes={'桂枝湯'}, max_cformulas=2, max_sformulas=3, penalty_factor=3, top_n=6,
         )
 
+    @mock.patch.object(cli.searcher, 'find_best_matches', return_value=[(75.0, ('芍藥甘草湯',), (3.0,))])
+    def test_search_output(self, m_find):
+        lines = [
+            line for line in cli.search(DATABASE_SAMPLE2, [('桂枝', 3), ('白芍', 6)], [], True)
+            if line is not None and not line.startswith('搜尋費時')
+        ]
+        self.assertEqual(lines[-6:], [
+            '匹配度: 75.00%，組合: 芍藥甘草湯:3.0 (總計: 3.0)',
+            '    **白芍**: 6.00',
+            '    炙甘草: 6.00',
+            '尚缺藥物:',
+            '    桂枝: 3.00',
+            '',
+        ])
+
+    @mock.patch.object(cli.searcher, 'find_best_matches', return_value=[(50.0, ('桂枝湯', '芍藥甘草湯'), (3.0, 0.0))])
+    def test_search_output_zero_amount(self, m_find):
+        lines = [
+            line for line in cli.search(DATABASE_SAMPLE2, [('桂枝', 9)], [], True)
+            if line is not None and not line.startswith('搜尋費時')
+        ]
+        self.assertEqual(lines[-5:], [
+            '匹配度: 50.00%，組合: 桂枝湯:3.0 芍藥甘草湯:0.0 (總計: 3.0)',
+            '    **桂枝**: 9.00',
+            '    炙甘草: 0.00',
+            '    白芍: 6.00',
+            '',
+        ])
+
+    def test_search_suggestions(self):
+        database = cli.searcher.FormulaDatabase({
+            '桂枝湯': {'桂枝': 3, '白芍': 2},
+            '桂枝加芍藥湯': {'桂枝': 3, '白芍': 4},
+            '桂枝去芍藥湯': {'桂枝': 3},
+            '麻黃湯': {'麻黃': 3, '桂枝': 2},
+        })
+        lines = list(cli.search(database, [('桂枝', 3)], [], False))
+        self.assertEqual(lines, ['資料庫尚未收錄「桂枝」。你是不是想找: 桂枝湯, 桂枝加芍藥湯, 桂枝去芍藥湯？'])
+
+        lines = list(cli.search(database, [('麻黃', 3)], [], False))
+        self.assertRegex(lines[0], r'^資料庫尚未收錄「麻黃」。你是不是想找: 麻黃湯')
+
+    @mock.patch.object(cli, 'process', None)
+    def test_get_close_matches_fallback(self):
+        self.assertEqual(
+            cli.get_close_matches('桂枝湯', ['桂枝', '芍藥甘草湯', '麻黃湯'], n=2, cutoff=0.1),
+            ['桂枝', '麻黃湯'],
+        )
+
+        # ties are sorted by reverse string
+        self.assertEqual(
+            cli.get_close_matches('桂枝湯', ['葛根湯', '麻黃湯', '桂枝', '芍藥甘草湯'], n=3, cutoff=0.1),
+            ['桂枝', '麻黃湯', '葛根湯'],
+        )
+
+    @unittest.skipUnless(cli.process, 'requires rapidfuzz')
+    def test_get_close_matches_rapidfuzz(self):
+        self.assertEqual(
+            cli.get_close_matches('桂枝湯', ['桂枝', '芍藥甘草湯', '麻黃湯'], n=2, cutoff=0.1),
+            ['桂枝', '麻黃湯'],
+        )
+
+        # ties are kept in the input order
+        self.assertEqual(
+            cli.get_close_matches('桂枝湯', ['葛根湯', '麻黃湯', '桂枝', '芍藥甘草湯'], n=3, cutoff=0.1),
+            ['桂枝', '葛根湯', '麻黃湯'],
+        )
+
+
+class TestCmdList(unittest.TestCase):
+    @mock.patch('sys.stdout', new_callable=StringIO)
+    @mock.patch.object(cli.searcher.FormulaDatabase, 'from_file', return_value=DATABASE_SAMPLE2)
+    def test_cmd_list(self, m_load, m_stdout):
+        cli.cmd_list(SimpleNamespace(
+            verbosity=50,
+            database='custom_db.yaml',
+            keywords=[],
+            raw=False,
+            any=False,
+        ))
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
+        self.assertEqual(m_stdout.getvalue(), '桂枝湯\n芍藥甘草湯\n')
+
+    @mock.patch('sys.stdout', new_callable=StringIO)
+    @mock.patch.object(cli.searcher.FormulaDatabase, 'from_file', return_value=DATABASE_SAMPLE2)
+    def test_cmd_list_raw(self, m_load, m_stdout):
+        cli.cmd_list(SimpleNamespace(
+            verbosity=50,
+            database='custom_db.yaml',
+            keywords=[],
+            raw=True,
+            any=False,
+        ))
+        m_load.assert_called_once_with('custom_db.yaml', use_cache=True)
+        self.assertEqual(m_stdout.getvalue(), '桂枝\n炙甘草\n白芍\n')
+
+    @mock.patch('sys.stdout', new_callable=StringIO)
+    @mock.patch.object(cli.searcher.FormulaDatabase, 'from_file', return_value=DATABASE_SAMPLE2)
+    def test_cmd_list_keywords(self, m_load, m_stdout):
+        cli.cmd_list(SimpleNamespace(
+            verbosity=50,
+            database='custom_db.yaml',
+            keywords=['桂', '湯'],
+            raw=False,
+            any=False,
+        ))
+        self.assertEqual(m_stdout.getvalue(), '桂枝湯\n')
+
+    @mock.patch('sys.stdout', new_callable=StringIO)
+    @mock.patch.object(cli.searcher.FormulaDatabase, 'from_file', return_value=DATABASE_SAMPLE2)
+    def test_cmd_list_keywords_any(self, m_load, m_stdout):
+        cli.cmd_list(SimpleNamespace(
+            verbosity=50,
+            database='custom_db.yaml',
+            keywords=['桂', '草'],
+            raw=True,
+            any=True,
+        ))
+        self.assertEqual(m_stdout.getvalue(), '桂枝\n炙甘草\n')
+
 
 class TestCmdConvert(unittest.TestCase):
     @mock.patch('sys.stdout', new_callable=StringIO)
-    @mock.patch.object(cli, 'converter')
-    def test_cmd_convert(self, m_converter, m_stdout):
+    @mock.patch.object(converter, 'LicenseFileHandler')
+    @mock.patch.object(converter, 'log')
+    def test_cmd_convert(self, m_log, m_handler_cls, m_stdout):
         m_handler = mock.Mock(**{'load.return_value': {'dummy': 'value'}})
-        m_converter.LicenseFileHandler.return_value = m_handler
+        m_handler_cls.return_value = m_handler
 
         cli.cmd_convert(SimpleNamespace(
             verbosity=50,
@@ -258,8 +461,22 @@ class TestCmdConvert(unittest.TestCase):
             config='custom_conf.yaml',
         ))
 
-        m_converter.log.setLevel.assert_called_once_with(50)
-        m_converter.LicenseFileHandler.assert_called_once_with()
+        m_log.setLevel.assert_called_once_with(50)
+        m_handler_cls.assert_called_once_with()
         m_handler.load_config.assert_called_once_with('custom_conf.yaml')
         m_handler.load.assert_called_once_with('input.csv', use_unit_dosage=False, filter_vendor=None)
         m_handler.dump.assert_called_once_with({'dummy': 'value'}, 'output.yaml')
+
+    @mock.patch('sys.stdout', new_callable=StringIO)
+    @mock.patch.object(converter, 'LicenseFileHandler')
+    def test_cmd_convert_default_config(self, m_handler_cls, m_stdout):
+        cli.cmd_convert(SimpleNamespace(
+            verbosity=50,
+            file='input.csv',
+            output='output.yaml',
+            vendor=None,
+            unit_dosage=False,
+            config=None,
+        ))
+
+        m_handler_cls.return_value.load_config.assert_called_once_with(converter.DEFAULT_CONFIG_FILE)
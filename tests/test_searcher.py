@@ -1,5 +1,8 @@
+import os
+import tempfile
 import unittest
 from io import StringIO
+from math import sqrt
 from textwrap import dedent
 from unittest import mock
 
@@ -86,6 +89,127 @@ class TestFormulaDatabase(unittest.TestCase):
             },
         })
 
+    def test_from_file_cache(self):
+        """Should cache the parsed file and invalidate the cache when the file changes."""
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             mock.patch.object(_searcher, 'CACHE_DIR', os.path.join(tmpdir, 'cache')):
+            cache_dir = os.path.join(tmpdir, 'cache')
+            file = os.path.join(tmpdir, 'db.yaml')
+            file2 = os.path.join(tmpdir, 'db2.yaml')
+            for f in (file, file2):
+                with open(f, 'w', encoding='utf-8') as fh:
+                    fh.write(dedent(
+                        """\
+                        - name: 芍藥甘草湯
+                          key: 芍藥甘草湯
+                          composition:
+                            白芍: 1.0
+                            炙甘草: 1.0
+                        """
+                    ))
+
+            # should not cache by default
+            database = _searcher.FormulaDatabase.from_file(file)
+            self.assertEqual(database, {'芍藥甘草湯': {'白芍': 1.0, '炙甘草': 1.0}})
+            self.assertFalse(os.path.exists(cache_dir))
+
+            database = _searcher.FormulaDatabase.from_file(file, use_cache=True)
+            self.assertEqual(database, {'芍藥甘草湯': {'白芍': 1.0, '炙甘草': 1.0}})
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            with mock.patch.object(_searcher.yaml, 'load') as m_load:
+                database = _searcher.FormulaDatabase.from_file(file, use_cache=True)
+            m_load.assert_not_called()
+            self.assertEqual(database, {'芍藥甘草湯': {'白芍': 1.0, '炙甘草': 1.0}})
+
+            _searcher.FormulaDatabase.from_file(file2, use_cache=True)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            with open(file, 'a', encoding='utf-8') as fh:
+                fh.write(dedent(
+                    """\
+                    - name: 甘草
+                      key: 甘草
+                      composition:
+                        甘草: 1.0
+                    """
+                ))
+
+            # should replace the stale cache of the same file only
+            database = _searcher.FormulaDatabase.from_file(file, use_cache=True)
+            self.assertEqual(database, {'芍藥甘草湯': {'白芍': 1.0, '炙甘草': 1.0}, '甘草': {'甘草': 1.0}})
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            with mock.patch.object(_searcher.yaml, 'load') as m_load:
+                _searcher.FormulaDatabase.from_file(file2, use_cache=True)
+            m_load.assert_not_called()
+
+    def test_from_file_cache_write_error(self):
+        """Should load the file and leave no temp file when the cache cannot be written."""
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             mock.patch.object(_searcher, 'CACHE_DIR', os.path.join(tmpdir, 'cache')):
+            cache_dir = os.path.join(tmpdir, 'cache')
+            file = os.path.join(tmpdir, 'db.yaml')
+            with open(file, 'w', encoding='utf-8') as fh:
+                fh.write(dedent(
+                    """\
+                    - name: 芍藥甘草湯
+                      key: 芍藥甘草湯
+                      composition:
+                        白芍: 1.0
+                        炙甘草: 1.0
+                    """
+                ))
+
+            with mock.patch.object(_searcher.pickle, 'dump', side_effect=OSError('No space left on device')):
+                database = _searcher.FormulaDatabase.from_file(file, use_cache=True)
+            self.assertEqual(database, {'芍藥甘草湯': {'白芍': 1.0, '炙甘草': 1.0}})
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_get_composition_vector(self):
+        database = _searcher.FormulaDatabase({
+            '桂枝湯': {'桂枝': 0.6, '白芍': 0.6, '炙甘草': 0.4},
+            '芍藥甘草湯': {'白芍': 0.6, '炙甘草': 0.6},
+            '桂枝': {'桂枝': 1.0},
+        })
+        self.assertEqual(database.herb_index, {'桂枝': 0, '白芍': 1, '炙甘草': 2})
+        np.testing.assert_allclose(
+            database.get_composition_vector(('桂枝湯', '芍藥甘草湯', '桂枝'), (2, 1, 0.5)),
+            [1.7, 1.8, 1.4],
+        )
+        np.testing.assert_allclose(
+            database.get_composition_vector(('芍藥甘草湯',), (2,)),
+            [0.0, 1.2, 1.2],
+        )
+        np.testing.assert_allclose(database.get_composition_vector((), ()), [0.0, 0.0, 0.0])
+
+    def test_formula_matrix(self):
+        database = _searcher.FormulaDatabase({
+            '桂枝湯': {'桂枝': 0.6, '白芍': 0.6, '炙甘草': 0.4},
+            '芍藥甘草湯': {'白芍': 0.6, '炙甘草': 0.6},
+            '桂枝': {'桂枝': 1.0},
+        })
+        np.testing.assert_allclose(database.formula_matrix, [
+            [0.6, 0.6, 0.4],
+            [0.0, 0.6, 0.6],
+            [1.0, 0.0, 0.0],
+        ])
+
+        self.assertEqual(database.herb_formulas, {
+            '桂枝': ['桂枝湯', '桂枝'],
+            '白芍': ['桂枝湯', '芍藥甘草湯'],
+            '炙甘草': ['桂枝湯', '芍藥甘草湯'],
+        })
+
+        # should be shared by searches, with target herbs not in the database appended
+        searcher = _searcher.BeamFormulaSearcher(database)
+        searcher._set_context({'桂枝': 1.0, '白芍': 1.0})
+        self.assertIs(searcher.formula_matrix, database.formula_matrix)
+        searcher._set_context({'桂枝': 1.0, '生薑': 1.0, '大棗': 1.0})
+        self.assertEqual(searcher.herb_index, {'桂枝': 0, '白芍': 1, '炙甘草': 2, '生薑': 3, '大棗': 4})
+        np.testing.assert_allclose(searcher.formula_matrix[:, 3:], np.zeros((3, 2)))
+        self.assertEqual(database.herb_index, {'桂枝': 0, '白芍': 1, '炙甘草': 2})
+
 
 class TestExhaustiveFormulaSearcher(unittest.TestCase):
     @classmethod
@@ -210,18 +334,20 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         searcher = _searcher.ExhaustiveFormulaSearcher(database)
 
         # should supplement herbs with largest remaining dosage
+        # should also generate shorter supplements, as a herb with little remaining dosage
+        # could be better left unsupplemented
         searcher._set_context(target_composition, max_cformulas=1, max_sformulas=5)
         self.assertEqual(
             list(searcher.generate_combinations_for_sformulas((), ())),
-            [('桂枝', '白芍', '生薑')],
+            [('桂枝',), ('桂枝', '白芍'), ('桂枝', '白芍', '生薑')],
         )
         self.assertEqual(
             list(searcher.generate_combinations_for_sformulas(('桂枝甘草湯',), (1.5,))),
-            [('桂枝甘草湯', '白芍', '生薑')],
+            [('桂枝甘草湯',), ('桂枝甘草湯', '白芍'), ('桂枝甘草湯', '白芍', '生薑')],
         )
         self.assertEqual(
             list(searcher.generate_combinations_for_sformulas(('芍藥甘草湯',), (2,))),
-            [('芍藥甘草湯', '桂枝', '生薑')],
+            [('芍藥甘草湯',), ('芍藥甘草湯', '桂枝'), ('芍藥甘草湯', '桂枝', '生薑')],
         )
 
         # should honor max_sformulas
@@ -232,11 +358,11 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         )
         self.assertEqual(
             list(searcher.generate_combinations_for_sformulas(('桂枝甘草湯',), (1.5,))),
-            [('桂枝甘草湯', '白芍')],
+            [('桂枝甘草湯',), ('桂枝甘草湯', '白芍')],
         )
         self.assertEqual(
             list(searcher.generate_combinations_for_sformulas(('芍藥甘草湯',), (2,))),
-            [('芍藥甘草湯', '桂枝')],
+            [('芍藥甘草湯',), ('芍藥甘草湯', '桂枝')],
         )
 
         # should honor max_sformulas
@@ -274,6 +400,7 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
 
         searcher._set_context(target_composition, max_cformulas=1, max_sformulas=2, places=2)
         self.assertEqual(list(searcher.generate_combinations_for_sformulas(combo, dosages)), [
+            ('芍藥甘草湯',),
             ('芍藥甘草湯', '炙甘草'),
         ])
 
@@ -288,6 +415,7 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         searcher = _searcher.ExhaustiveFormulaSearcher(database)
         searcher._set_context(target_composition, max_cformulas=1, max_sformulas=3)
         self.assertEqual(list(searcher.generate_combinations_for_sformulas((), ())), [
+            ('桂枝',), ('製桂枝',),
             ('桂枝', '白芍'), ('桂枝', '芍藥'), ('桂枝', '炒白芍'),
             ('製桂枝', '白芍'), ('製桂枝', '芍藥'), ('製桂枝', '炒白芍'),
         ])
@@ -305,6 +433,17 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         self.assertEqual(searcher.calculate_delta([2, 0], ['桂枝湯', '桂枝去芍藥湯']), 0)
         self.assertEqual(searcher.calculate_delta([0, 2], ['桂枝湯', '桂枝去芍藥湯']), 1.2)
 
+    def test_calculate_delta_with_target_composition(self):
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+        }
+
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context({'甲藥': 1.0}, penalty_factor=2.0)
+        self.assertAlmostEqual(searcher.calculate_delta([1], ('甲複方',), {'甲藥': 1.0, '乙藥': 1.0}), 0.0)
+        self.assertAlmostEqual(searcher.calculate_delta([1], ('甲複方',), {'乙藥': 1.0}), 2.0)
+        self.assertAlmostEqual(searcher.calculate_delta([1], ('甲複方',), {'甲藥': 1.0, '丙藥': 3.0}), sqrt(4.0 + 9.0))
+
     def test_calculate_delta_with_penalty(self):
         database = {
             '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
@@ -339,9 +478,58 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
             '桂枝': 1.2, '白芍': 1.2, '生薑': 1.2, '大棗': 1.0, '炙甘草': 0.8, '白朮': 1.0,
         }, penalty_factor=2.0)
         dosages, delta = searcher.find_best_dosages(['桂枝湯', '桂枝去芍藥湯'])
-        np.testing.assert_allclose(dosages, [1.997, 0.000], atol=1e-3)
+        np.testing.assert_allclose(dosages, [2, 0], atol=1e-3)
         self.assertAlmostEqual(delta, 1, places=3)
 
+    def test_find_best_dosages_single_formula(self):
+        database = {
+            '桂枝湯': {'桂枝': 0.6, '白芍': 0.6, '生薑': 0.6, '大棗': 0.5, '炙甘草': 0.4},
+            '苓桂朮甘湯': {'桂枝': 1, '茯苓': 1, '白朮': 0.8, '炙甘草': 0.4},
+        }
+
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context({'桂枝': 1.2, '白芍': 1.2, '生薑': 1.2, '大棗': 1.0, '炙甘草': 0.8, '人參': 1.0})
+
+        dosages, delta = searcher.find_best_dosages(['桂枝湯'])
+        np.testing.assert_allclose(dosages, [2])
+        self.assertAlmostEqual(delta, 1)
+
+        # weighted: (1 * 1.2 + 0.4 * 0.8) / (1 ** 2 + 2 ** 2 + 1.6 ** 2 + 0.4 ** 2)
+        dosages, delta = searcher.find_best_dosages(['苓桂朮甘湯'])
+        np.testing.assert_allclose(dosages, [1.52 / 7.72])
+        self.assertAlmostEqual(delta, searcher.calculate_delta(dosages, ['苓桂朮甘湯']))
+
+        # should honor bounds
+        dosages, delta = searcher.find_best_dosages(['桂枝湯'], bounds=[(0, 1)])
+        np.testing.assert_allclose(dosages, [1])
+        dosages, delta = searcher.find_best_dosages(['桂枝湯'], bounds=[(3, 5)])
+        np.testing.assert_allclose(dosages, [3])
+
+    def test_find_best_dosages_two_formulas(self):
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '丙藥': 1.0},
+            '丙複方': {'甲藥': 2.0, '乙藥': 2.0},
+        }
+
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context({'甲藥': 1.0, '乙藥': 3.0, '丙藥': 2.0})
+
+        # unconstrained solution within bounds
+        dosages, delta = searcher.find_best_dosages(['甲複方', '乙複方'])
+        np.testing.assert_allclose(dosages, [1, 2])
+        self.assertAlmostEqual(delta, 0)
+
+        # solution on a bound
+        dosages, delta = searcher.find_best_dosages(['甲複方', '乙複方'], bounds=[(0, 50), (0, 1)])
+        np.testing.assert_allclose(dosages, [1.5, 1])
+        self.assertAlmostEqual(delta, searcher.calculate_delta(dosages, ['甲複方', '乙複方']))
+
+        # collinear formulas
+        dosages, delta = searcher.find_best_dosages(['甲複方', '丙複方'])
+        np.testing.assert_allclose(dosages @ [1, 2], 2)
+        self.assertAlmostEqual(delta, sqrt(6))
+
     def test_calculate_match_perfect_fit(self):
         """Should result in nearly 0 delta and 100% match_pct when combo can fit target perfectly."""
         database = {
@@ -409,6 +597,25 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         self.assertAlmostEqual(delta, 0.0, places=3)
         self.assertAlmostEqual(match_pct, 100.0, places=2)
 
+    def test_calculate_match_cached_permuted_combo(self):
+        """Should reorder cached dosages for the same formulas in another order."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '乙複方': {'乙藥': 1.0, '丙藥': 1.0},
+        }
+        target_composition = {'甲藥': 1.0, '乙藥': 3.0, '丙藥': 2.0}
+
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+        searcher._set_context(target_composition)
+        dosages, _, match_pct = searcher.calculate_match(('甲複方', '乙複方'))
+        np.testing.assert_allclose(dosages, [1, 2])
+
+        with mock.patch.object(searcher, '_calculate_match') as m_calc:
+            dosages2, _, match_pct2 = searcher.calculate_match(('乙複方', '甲複方'))
+        m_calc.assert_not_called()
+        np.testing.assert_allclose(dosages2, [2, 1])
+        self.assertEqual(match_pct2, match_pct)
+
     def test_evaluate_combination_basic(self):
         """Should return values as underlying `calculate_match` does."""
         database = {
@@ -502,6 +709,27 @@ class TestExhaustiveFormulaSearcher(unittest.TestCase):
         self.assertEqual(combo, ('桂枝去芍藥湯',))
         np.testing.assert_allclose(dosages, [2], atol=1e-3)
 
+    def test_find_best_matches_fewer_sformulas(self):
+        """Should not force a sformula for a herb whose remaining dosage is little."""
+        database = {
+            '甲複方': {'甲藥': 1.0, '乙藥': 1.0},
+            '丙單方': {'丙藥': 1.0},
+            '乙單方': {'乙藥': 1.0},
+        }
+        target_composition = {'甲藥': 2.0, '乙藥': 2.1, '丙藥': 1.0}
+        searcher = _searcher.ExhaustiveFormulaSearcher(database)
+
+        # 乙藥 remains 0.1 after 甲複方:2.0, but 乙單方 is at least 0.3
+        best_matches = searcher.find_best_matches(
+            3, target_composition, max_cformulas=1, max_sformulas=2,
+            min_cformula_dose=1.0, min_sformula_dose=0.3)
+        self.assertEqual([combo for _, combo, _ in best_matches], [
+            ('甲複方', '丙單方'),
+            ('甲複方', '丙單方', '乙單方'),
+            ('甲複方',),
+        ])
+        np.testing.assert_allclose(best_matches[0][2], [2, 1])
+
 
 class TestBeamFormulaSearcher(unittest.TestCase):
     @staticmethod
@@ -651,7 +879,7 @@ class TestBeamFormulaSearcher(unittest.TestCase):
 
     def test_generate_combinations_beam_width(self):
         """Should pass items up to beam width in order of match_pct for each (non-last) depth."""
-        def se_eval(combo, *, initial_guess=None):
+        def se_eval(combo):
             return combo, (1.0,) * len(combo), 50.0 + 10 * len(combo)
 
         database, target_composition = self._sample_data()
@@ -928,13 +1156,11 @@ class TestBeamFormulaSearcher(unittest.TestCase):
 
         self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
 
-        for formula, score in expected_scores.items():
-            self.assertAlmostEqual(
-                searcher._calculate_formula_score(formula, remaining_map),
-                score,
-                places=3,
-                msg=f'mismatching score for {formula!r}',
-            )
+        np.testing.assert_allclose(
+            searcher._calculate_cformula_scores(remaining_map, list(expected_scores)),
+            list(expected_scores.values()),
+            atol=1e-3,
+        )
 
     def test_generate_heuristic_candidates_scoring(self):
         combo = ()
@@ -1101,9 +1327,16 @@ class TestBeamFormulaSearcher(unittest.TestCase):
         self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
 
         # check for expected scores
-        self.assertAlmostEqual(searcher._calculate_formula_score('甲複方', remaining_map), 0.800, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('乙複方', remaining_map), 0.174, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('丙複方', remaining_map), 0.924, places=3)
+        np.testing.assert_allclose(
+            searcher._calculate_cformula_scores(remaining_map, ['甲複方', '乙複方', '丙複方']),
+            [0.800, 0.174, 0.924],
+            atol=1e-3,
+        )
+        np.testing.assert_allclose(
+            searcher._calculate_cformula_scores(remaining_map),
+            [0.800, 0.174, 0.924],
+            atol=1e-3,
+        )
 
         # check for expected order by scores
         # should limit generated item number within `quota`
@@ -1143,9 +1376,11 @@ class TestBeamFormulaSearcher(unittest.TestCase):
         self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
 
         # check for expected scores
-        self.assertAlmostEqual(searcher._calculate_formula_score('甲複方', remaining_map), 0.943, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('乙複方', remaining_map), 0.707, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('丙複方', remaining_map), 0.745, places=3)
+        np.testing.assert_allclose(
+            searcher._calculate_cformula_scores(remaining_map, ['甲複方', '乙複方', '丙複方']),
+            [0.943, 0.707, 0.745],
+            atol=1e-3,
+        )
 
         # check for expected order by scores
         # should limit generated item number within `quota`
@@ -1184,8 +1419,11 @@ class TestBeamFormulaSearcher(unittest.TestCase):
         self.assertEqual(searcher._calculate_remaining_map(combo, dosages), remaining_map)
 
         # check for expected scores
-        self.assertAlmostEqual(searcher._calculate_formula_score('乙複方', remaining_map), 0.800, places=3)
-        self.assertAlmostEqual(searcher._calculate_formula_score('丙複方', remaining_map), 0.632, places=3)
+        np.testing.assert_allclose(
+            searcher._calculate_cformula_scores(remaining_map, ['乙複方', '丙複方']),
+            [0.800, 0.632],
+            atol=1e-3,
+        )
 
         # check for expected order by scores
         # should limit generated item number within `quota`